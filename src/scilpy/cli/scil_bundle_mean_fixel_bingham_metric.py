@@ -89,10 +89,10 @@ def main():
         parser.error('Dimension mismatch between Bingham coefficients '
                      'and Bingham metric image.')
 
+    bingham = bingham_img.get_fdata(dtype=np.float32)
+    metric = metric_img.get_fdata(dtype=np.float32)
     metric_mean_map =\
-        bingham_metric_map_along_streamlines(sft,
-                                             bingham_img.get_fdata(),
-                                             metric_img.get_fdata(),
+        bingham_metric_map_along_streamlines(sft, bingham, metric,
                                              args.max_theta,
                                              args.length_weighting)
 
@@ -2,22 +2,38 @@
 # -*- coding: utf-8 -*-
 """
 Concatenate DWI, bval and bvecs together. File must be specified in matching
-order. Default data type will be the same as the first input DWI.
+order. Default data type will be the same as the input DWI if they all share
+the same data type without scaling (scl_slope, scl_inter), float32 otherwise.
+
+If the output DWI is an uncompressed NIfTI (.nii), it is written directly to
+disk as the inputs are read, so the concatenated image never needs to fit in
+memory. It is written to a temporary file in the output directory, renamed
+once complete.
+
+With --processes, the input DWI are read and decompressed in parallel
+threads. Up to that number of input images are then held in memory at once.
 
 """
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import logging
+import os
+import tempfile
 
 from dipy.io.gradients import read_bvals_bvecs
 from dipy.io.utils import is_header_compatible
 import nibabel as nib
 import numpy as np
 
+from scilpy.io.image import create_nifti_memmap
 from scilpy.io.utils import (add_overwrite_arg,
                              add_verbose_arg,
                              assert_inputs_exist,
-                             assert_outputs_exist)
+                             assert_outputs_exist,
+                             validate_nbr_processes)
 from scilpy.version import version_string
 
 
@@ -44,12 +60,78 @@ def _build_arg_parser():
                    help='Data type of the output image. Use the format: '
                         'uint8, int16, int/float32, int/float64.')
 
+    p.add_argument('--processes', dest='nbr_processes',
+                   metavar='NBR', type=int, default=1,
+                   help='Number of threads used to read the input DWI.\n'
+                        'At most NBR input images are held in memory at '
+                        'once.\nDefault: [%(default)s]')
     add_verbose_arg(p)
     add_overwrite_arg(p)
 
     return p
 
 
+def _read_dwi_into(in_dwis, all_dwi, nbr_cpu):
+    """
+    Copy the data of the input images, in order, along the last axis of
+    all_dwi. Images are read by nbr_cpu threads, with at most nbr_cpu images
+    in memory at once. With a single process, they are read one at a time in
+    the main thread.
+    """
+    last_count = 0
+    if nbr_cpu == 1:
+        for curr_dwi in in_dwis:
+            curr_data = np.asanyarray(curr_dwi.dataobj)
+            curr_size = curr_data.shape[-1]
+            all_dwi[..., last_count:last_count+curr_size] = curr_data
+            last_count += curr_size
+            del curr_data
+        return
+
+    in_dwis = iter(in_dwis)
+    with ThreadPoolExecutor(max_workers=nbr_cpu) as executor:
+        pending = deque(executor.submit(np.asanyarray, curr_dwi.dataobj)
+                        for curr_dwi in islice(in_dwis, nbr_cpu))
+        while pending:
+            curr_data = pending.popleft().result()
+            curr_size = curr_data.shape[-1]
+            all_dwi[..., last_count:last_count+curr_size] = curr_data
+            last_count += curr_size
+            del curr_data
+
+            # The next read is only started once an image has been copied.
+            for curr_dwi in islice(in_dwis, 1):
+                pending.append(executor.submit(np.asanyarray,
+                                               curr_dwi.dataobj))
+
+
+def _get_output_dtype(in_dwis):
+    """
+    Data type of the inputs on disk if they all share it without scaling.
+    Otherwise, float32, as scaled values do not fit in the integer type.
+    """
+    dtype = in_dwis[0].get_data_dtype()
+    for curr_dwi in in_dwis:
+        if curr_dwi.get_data_dtype() != dtype \
+                or curr_dwi.dataobj.slope != 1 or curr_dwi.dataobj.inter != 0:
+            return np.dtype(np.float32)
+    return dtype
+
+
+def _create_tmp_nifti(filename):
+    """
+    Create an empty temporary .nii file in the directory of filename, with
+    the permissions a new file would get.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        suffix='.nii', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_filename, 0o666 & ~umask)
+    return tmp_filename
+
+
 def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
@@ -62,6 +144,7 @@ def main():
     assert_inputs_exist(parser, args.in_dwis + args.in_bvals + args.in_bvecs)
     assert_outputs_exist(parser, args, [args.out_dwi, args.out_bval,
                                         args.out_bvec])
+    nbr_cpu = validate_nbr_processes(parser, args)
 
     all_bvals = []
     all_bvecs = []
@@ -76,24 +159,46 @@ def main():
     all_bvals = np.concatenate(all_bvals)
     all_bvecs = np.concatenate(all_bvecs)
 
-    ref_dwi = nib.load(args.in_dwis[0])
-    all_dwi = np.zeros(ref_dwi.shape[0:3] + (total_size,),
-                       dtype=args.data_type)
-    last_count = ref_dwi.shape[-1]
-    all_dwi[..., 0:last_count] = ref_dwi.get_fdata()
-    for i in range(1, len(args.in_dwis)):
-        curr_dwi = nib.load(args.in_dwis[i])
+    # Headers are all checked before any image data is read.
+    in_dwis = [nib.load(in_dwi) for in_dwi in args.in_dwis]
+    ref_dwi = in_dwis[0]
+    for curr_dwi in in_dwis:
         if not is_header_compatible(curr_dwi, ref_dwi):
             raise ValueError('All DWI must have the compatible header.')
-        curr_size = curr_dwi.shape[-1]
-        all_dwi[..., last_count:last_count+curr_size] = \
-            curr_dwi.get_fdata()
-        last_count += curr_size
-
-    np.savetxt(args.out_bval, all_bvals, '%d')
-    np.savetxt(args.out_bvec, all_bvecs.T, '%0.15f')
-    nib.save(nib.Nifti1Image(all_dwi, ref_dwi.affine, header=ref_dwi.header),
-             args.out_dwi)
+
+    dtype = args.data_type or _get_output_dtype(in_dwis)
+    out_shape = ref_dwi.shape[0:3] + (total_size,)
+    if args.out_dwi.endswith('.nii'):
+        # The image is written to a temporary file, only moved to out_dwi
+        # once all inputs are copied. This way, out_dwi can also be one of
+        # the inputs, and a failure leaves no partially filled image behind.
+        tmp_dwi = _create_tmp_nifti(args.out_dwi)
+        try:
+            all_dwi = create_nifti_memmap(tmp_dwi, out_shape, dtype,
+                                          ref_dwi.affine,
+                                          header=ref_dwi.header)
+            _read_dwi_into(in_dwis, all_dwi, nbr_cpu)
+            all_dwi.flush()
+            del all_dwi
+        except BaseException:
+            os.remove(tmp_dwi)
+            raise
+        os.replace(tmp_dwi, args.out_dwi)
+    else:
+        all_dwi = np.zeros(out_shape, dtype=dtype)
+        _read_dwi_into(in_dwis, all_dwi, nbr_cpu)
+        out_img = nib.Nifti1Image(all_dwi, ref_dwi.affine,
+                                  header=ref_dwi.header)
+        out_img.set_data_dtype(dtype)
+        nib.save(out_img, args.out_dwi)
+
+    # Same layout as np.savetxt (one b-value per line, one row per bvec
+    # axis), but each file is formatted with a single string operation.
+    with open(args.out_bval, 'w') as f:
+        f.write(('%d\n' * len(all_bvals)) % tuple(all_bvals))
+    with open(args.out_bvec, 'w') as f:
+        row_fmt = ' '.join(['%0.15f'] * len(all_bvecs)) + '\n'
+        f.write((row_fmt * 3) % tuple(all_bvecs.T.ravel()))
 
 
 if __name__ == "__main__":
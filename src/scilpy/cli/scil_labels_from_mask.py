@@ -62,8 +62,9 @@ def main():
     label_map = get_labels_from_mask(
         mask_data, args.labels, args.background_label,
         min_voxel_count=min_voxel_count)
-    # Save result
-    out_img = nib.Nifti1Image(label_map.astype(np.uint16), mask_img.affine)
+    # Save result, using the smallest data type holding all labels
+    dtype = np.uint8 if label_map.max() < 256 else np.uint16
+    out_img = nib.Nifti1Image(label_map.astype(dtype), mask_img.affine)
     nib.save(out_img, args.out_labels)
 
 
@@ -4,6 +4,9 @@
 import os
 import tempfile
 
+import nibabel as nib
+import numpy as np
+
 from scilpy import SCILPY_HOME
 from scilpy.io.fetcher import fetch_data, get_testing_files_dict
 
@@ -31,3 +34,52 @@ def test_execution_processing_concatenate(script_runner, monkeypatch):
                              '--in_bvals', in_bval, in_bval,
                              '--in_bvecs', in_bvec, in_bvec])
     assert ret.success
+
+
+def test_execution_processing_concatenate_uncompressed(script_runner,
+                                                       monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_dwi = os.path.join(SCILPY_HOME, 'processing',
+                          'dwi_crop.nii.gz')
+    in_bval = os.path.join(SCILPY_HOME, 'processing',
+                           'dwi.bval')
+    in_bvec = os.path.join(SCILPY_HOME, 'processing',
+                           'dwi.bvec')
+    ret = script_runner.run(['scil_dwi_concatenate', 'dwi_concat.nii',
+                             'concat.bval', 'concat.bvec',
+                             '--in_dwi', in_dwi, in_dwi,
+                             '--in_bvals', in_bval, in_bval,
+                             '--in_bvecs', in_bvec, in_bvec,
+                             '--data_type', 'float32', '-f'])
+    assert ret.success
+
+
+def test_execution_concatenate_scaled(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    # int16 input stored with a non-unit scl_slope, and an unscaled one
+    data = np.random.default_rng(0).uniform(0, 1000, (4, 4, 4, 3))
+    scaled_img = nib.Nifti1Image(data, np.eye(4))
+    scaled_img.set_data_dtype(np.int16)
+    scaled_img.header.set_slope_inter(0.37, 0)
+    nib.save(scaled_img, 'dwi_scaled.nii.gz')
+    unscaled_img = nib.Nifti1Image(np.round(data).astype(np.int16),
+                                   np.eye(4))
+    nib.save(unscaled_img, 'dwi_unscaled.nii.gz')
+    np.savetxt('dwi.bval', [0, 1000, 1000], '%d')
+    np.savetxt('dwi.bvec', np.eye(3), '%0.15f')
+
+    for out_dwi in ['dwi_scaled_concat.nii.gz', 'dwi_scaled_concat.nii']:
+        ret = script_runner.run(['scil_dwi_concatenate', out_dwi,
+                                 'scaled_concat.bval', 'scaled_concat.bvec',
+                                 '--in_dwi', 'dwi_scaled.nii.gz',
+                                 'dwi_unscaled.nii.gz',
+                                 '--in_bvals', 'dwi.bval', 'dwi.bval',
+                                 '--in_bvecs', 'dwi.bvec', 'dwi.bvec', '-f'])
+        assert ret.success
+
+        out_img = nib.load(out_dwi)
+        assert out_img.get_data_dtype() == np.float32
+        expected = np.concatenate(
+            [nib.load('dwi_scaled.nii.gz').get_fdata(),
+             unscaled_img.get_fdata()], axis=-1)
+        assert np.allclose(out_img.get_fdata(), expected, atol=1e-3)
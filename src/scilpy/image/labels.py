@@ -99,13 +99,15 @@ def get_labels_from_mask(mask_data, labels=None, background_label=0,
     # Get the number of structures and assign labels to each blob
     label_map, nb_structures = ndi.label(mask_data)
     if min_voxel_count:
-        new_count = 0
-        for label in range(1, nb_structures + 1):
-            if np.count_nonzero(label_map == label) < min_voxel_count:
-                label_map[label_map == label] = 0
-            else:
-                new_count += 1
-                label_map[label_map == label] = new_count
+        # Renumber the kept blobs consecutively through a lookup table
+        blob_sizes = np.bincount(label_map.ravel(),
+                                 minlength=nb_structures + 1)
+        is_kept = blob_sizes >= min_voxel_count
+        is_kept[0] = False
+        new_count = np.count_nonzero(is_kept)
+        lut = np.zeros(nb_structures + 1, dtype=label_map.dtype)
+        lut[is_kept] = np.arange(1, new_count + 1)
+        label_map = lut[label_map]
         logging.debug(
             f"Ignored blob {nb_structures-new_count} with fewer "
             "than {min_voxel_count} voxels")
@@ -126,13 +128,12 @@ def get_labels_from_mask(mask_data, labels=None, background_label=0,
                              " blobs in the mask ({}).".format(
                                  len(labels), nb_structures))
 
-        # Copy the label map to avoid scenarios where the label list contains
-        # labels that are already present in the label map
-        custom_label_map = label_map.copy()
-        # Assign labels to each blob
-        for idx, label in enumerate(labels[:nb_structures]):
-            custom_label_map[label_map == idx + 1] = label
-        label_map = custom_label_map
+        # Assign labels to each blob through a lookup table, which avoids
+        # scenarios where the label list contains labels that are already
+        # present in the label map
+        lut = np.zeros(nb_structures + 1, dtype=label_map.dtype)
+        lut[1:] = labels[:nb_structures]
+        label_map = lut[label_map]
 
     logging.info('Assigned labels {} to the mask.'.format(
         np.unique(label_map[label_map != background_label])))
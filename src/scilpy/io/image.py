@@ -124,3 +124,51 @@ def get_data_as_mask(mask_img, dtype=np.uint8):
                       '--data_type uint8 -f'.format(basename, curr_type))
 
     return data
+
+
+def create_nifti_memmap(filename, shape, dtype, affine, header=None):
+    """
+    Create an uncompressed NIfTI file on disk and return its data as a
+    writable memory-mapped array. This allows writing images larger than the
+    available memory, one chunk at a time.
+
+    Parameters
+    ----------
+    filename: str
+        Output filename. Must be an uncompressed NIfTI file (.nii).
+    shape: tuple
+        Shape of the image.
+    dtype: type or str
+        Data type of the image. Data is written without scaling.
+    affine: numpy.ndarray (4, 4)
+        Affine of the image.
+    header: nibabel.nifti1.Nifti1Header, optional
+        Header from which to copy the other fields (e.g. zooms, xyzt_units).
+
+    Return
+    ------
+    data: numpy.memmap
+        Zero-initialized data of the image, in the file's (Fortran) order.
+        Call flush() once it has been filled.
+    """
+    if not filename.endswith('.nii'):
+        raise ValueError('Memory-mapped output is only possible for '
+                         'uncompressed NIfTI files (.nii). Got {}.'
+                         .format(filename))
+
+    # Let nibabel fill the affine-related fields of the header.
+    hdr = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                          affine, header=header).header
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(None, None)
+    hdr['vox_offset'] = 0  # Recomputed by write_to, after the extensions
+
+    with open(filename, 'wb') as f:
+        hdr.write_to(f)
+        offset = int(hdr['vox_offset'])
+        nb_bytes = int(np.prod(shape)) * hdr.get_data_dtype().itemsize
+        f.truncate(offset + nb_bytes)
+
+    return np.memmap(filename, dtype=hdr.get_data_dtype(), mode='r+',
+                     offset=offset, shape=shape, order='F')
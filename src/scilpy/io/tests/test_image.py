@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from scilpy.io.image import create_nifti_memmap
+
+tmp_dir = tempfile.TemporaryDirectory()
+
+
+def test_create_nifti_memmap():
+    filename = os.path.join(tmp_dir.name, 'memmap.nii')
+    shape = (4, 5, 6, 3)
+    affine = np.diag([2., 2., 3., 1.])
+    affine[:3, 3] = [-10., 5., 7.]
+    header = nib.Nifti1Image(np.zeros(shape, dtype=np.float32),
+                             affine).header
+    header.set_zooms((2., 2., 3., 1.5))
+
+    data = create_nifti_memmap(filename, shape, np.int16, affine,
+                               header=header)
+    assert isinstance(data, np.memmap)
+    assert data.shape == shape
+    assert np.count_nonzero(data) == 0
+
+    expected = np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+    data[..., :2] = expected[..., :2]
+    data[..., 2:] = expected[..., 2:]
+    data.flush()
+    del data
+
+    img = nib.load(filename)
+    assert img.get_data_dtype() == np.int16
+    assert img.header.get_slope_inter() == (None, None)
+    assert np.array_equal(np.asanyarray(img.dataobj), expected)
+    assert np.allclose(img.affine, affine)
+    assert np.allclose(img.header.get_zooms(), (2., 2., 3., 1.5))
+    assert img.dataobj.offset == 352
+
+    # nibabel resets vox_offset once loaded, so check it on disk.
+    with open(filename, 'rb') as f:
+        assert nib.Nifti1Header.from_fileobj(f)['vox_offset'] == 352
+
+
+def test_create_nifti_memmap_compressed():
+    filename = os.path.join(tmp_dir.name, 'memmap.nii.gz')
+    with pytest.raises(ValueError):
+        create_nifti_memmap(filename, (2, 2, 2), np.float32, np.eye(4))
@@ -122,12 +122,12 @@ def bingham_to_peak_direction(bingham_volume):
     """
     mu1s = bingham_volume[..., 1:4]  # (X, Y, Z, 5, 3)
     mu2s = bingham_volume[..., 4:7]  # (X, Y, Z, 5, 3)
-    k1s = np.linalg.norm(mu1s, axis=-1)  # (X, Y, Z, 5)
-    k2s = np.linalg.norm(mu2s, axis=-1)  # (X, Y, Z, 5)
+    k1s = np.linalg.norm(mu1s, axis=-1, keepdims=True)  # (X, Y, Z, 5, 1)
+    k2s = np.linalg.norm(mu2s, axis=-1, keepdims=True)  # (X, Y, Z, 5, 1)
 
-    # normalize mu1 and mu2
-    mu1s[k1s != 0] /= k1s[k1s != 0][..., None]
-    mu2s[k2s != 0] /= k2s[k2s != 0][..., None]
+    # normalize mu1 and mu2, leaving the input volume untouched
+    mu1s = np.divide(mu1s, k1s, out=np.zeros_like(mu1s), where=k1s != 0)
+    mu2s = np.divide(mu2s, k2s, out=np.zeros_like(mu2s), where=k2s != 0)
 
     # compute peak direction
     peak_dir = np.cross(mu1s, mu2s)
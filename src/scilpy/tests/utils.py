@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+import nibabel as nib
 import numpy as np
 
 
@@ -13,3 +15,15 @@ def nan_array_equal(a, b):
     a = a[~np.isnan(a)]
     b = b[~np.isnan(b)]
     return np.array_equal(a, b) and np.array_equal(nan_a, nan_b)
+
+
+def build_sft_in_voxel_space(streamlines, shape):
+    """
+    Build a StatefulTractogram from streamlines in voxel space (corner
+    origin), with an identity-affine reference of the given shape.
+    """
+    reference = nib.Nifti1Image(np.zeros(shape, dtype=np.float32),
+                                np.eye(4))
+    return StatefulTractogram(streamlines=streamlines,
+                              reference=reference,
+                              space=Space.VOX, origin=Origin('corner'))
@@ -109,13 +109,13 @@ def _afd_and_rd_sums_along_streamlines(sft, fodf, fodf_basis,
     for split_streamlines in all_split_streamlines:
         # Get the direction of each segment
         segments = split_streamlines[1:] - split_streamlines[:-1]
-        seg_lengths = np.linalg.norm(segments, axis=1)
+        seg_sq_lengths = np.einsum('ij,ij->i', segments, segments)
 
         # Remove segments of length zero.
         # This removes numpy warnings of division by zero.
-        non_zero_lengths = np.nonzero(seg_lengths)[0]
+        non_zero_lengths = np.nonzero(seg_sq_lengths)[0]
         segments = segments[non_zero_lengths]
-        seg_lengths = seg_lengths[non_zero_lengths]
+        seg_lengths = np.sqrt(seg_sq_lengths[non_zero_lengths])
 
         # Find closest point on sphere
         test = np.dot(segments, sphere.vertices.T)
@@ -135,19 +135,20 @@ def _afd_and_rd_sums_along_streamlines(sft, fodf, fodf_basis,
             normalization_weights = seg_lengths / \
                 np.linalg.norm(fodf.header.get_zooms()[:3])
 
-        for vox_idx, closest_vertex_index, norm_weight in zip(
-                vox_indices, closest_vertex_indices, normalization_weights):
-            vox_idx = tuple(vox_idx)
+        # Voxel indices as Python ints, for plain integer indexing
+        for (ix, iy, iz), closest_vertex_index, norm_weight in zip(
+                vox_indices.tolist(), closest_vertex_indices,
+                normalization_weights):
             b_at_idx = b_matrix.T[closest_vertex_index]
-            fodf_at_index = fodf_data[vox_idx]
+            fodf_at_index = fodf_data[ix, iy, iz]
 
             afd_val = np.dot(b_at_idx, fodf_at_index)
             rd_val = np.dot(np.dot(b_at_idx.T, p_matrix),
                             fodf_at_index)
 
-            afd_sum_map[vox_idx] += afd_val * norm_weight
-            rd_sum_map[vox_idx] += rd_val * norm_weight
-            weight_map[vox_idx] += norm_weight
+            afd_sum_map[ix, iy, iz] += afd_val * norm_weight
+            rd_sum_map[ix, iy, iz] += rd_val * norm_weight
+            weight_map[ix, iy, iz] += norm_weight
 
     rd_sum_map[rd_sum_map < 0.] = 0.
     return afd_sum_map, rd_sum_map, weight_map
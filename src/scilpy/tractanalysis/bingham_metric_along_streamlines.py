@@ -1,6 +1,23 @@
 # -*- coding: utf-8 -*-
 
+from math import sqrt
+
 import numpy as np
+try:
+    from numba import config, get_num_threads, njit, prange
+    have_numba = True
+
+    # Once started, the TBB threading layer (Numba's default when it is
+    # installed) deadlocks processes forked by multiprocessing. Unless one
+    # was chosen by the user, the fork-safe workqueue layer is used instead.
+    if config.THREADING_LAYER == 'default':
+        config.THREADING_LAYER = 'workqueue'
+except ImportError:
+    # Without Numba, the compiled (serial) Cython kernel is used instead.
+    from scilpy.tractanalysis.bingham_metric_kernel import \
+        bingham_metric_sum_kernel
+    have_numba = False
+
 from scilpy.reconst.bingham import bingham_to_peak_direction
 from scilpy.tractanalysis.voxel_boundary_intersection import\
     subdivide_streamlines_at_voxel_faces
@@ -33,9 +50,7 @@ def bingham_metric_map_along_streamlines(sft, bingham_coeffs,
                                              metric, max_theta,
                                              length_weighting)
 
-    non_zeros = np.nonzero(fd_sum)
-    weights_nz = weights[non_zeros]
-    fd_sum[non_zeros] /= weights_nz
+    np.divide(fd_sum, weights, out=fd_sum, where=weights != 0)
 
     return fd_sum
 
@@ -74,45 +89,170 @@ def bingham_metric_sum_along_streamlines(sft, bingham_coeffs, metric,
     weight_map = np.zeros(metric.shape[:-1])
     min_cos_theta = np.cos(np.radians(max_theta))
 
+    # Lobe peak directions are computed once for the whole volume. Inputs
+    # are used in float32, sums are accumulated in float64.
+    bingham_coeffs = np.asarray(bingham_coeffs, dtype=np.float32)
+    metric = np.ascontiguousarray(metric, dtype=np.float32)
+    peaks = np.ascontiguousarray(bingham_to_peak_direction(bingham_coeffs))
+
+    # Segments in voxels where the metric is zero for all lobes only
+    # contribute to the weight map, the lobe lookup can be skipped.
+    metric_any = np.any(metric, axis=-1)
+
     sft.streamlines._data = sft.streamlines._data.astype(np.float32)
     all_split_streamlines = \
         subdivide_streamlines_at_voxel_faces(sft.streamlines)
-    for split_streamlines in all_split_streamlines:
-        segments = split_streamlines[1:] - split_streamlines[:-1]
-        seg_lengths = np.linalg.norm(segments, axis=1)
+    points = all_split_streamlines._data
+    if len(points) == 0:
+        return metric_sum_map, weight_map
+
+    # Sums are accumulated over the voxel bounding box of the bundle only.
+    bbox_min = np.clip(np.floor(points.min(axis=0)).astype(np.intp),
+                       0, metric.shape[:-1])
+    bbox_max = np.clip(np.floor(points.max(axis=0)).astype(np.intp) + 1,
+                       bbox_min, metric.shape[:-1])
+    bbox = tuple(slice(start, end) for start, end in zip(bbox_min, bbox_max))
+    bbox_shape = tuple(bbox_max - bbox_min)
 
-        # Remove points where the segment is zero.
-        # This removes numpy warnings of division by zero.
-        non_zero_lengths = np.nonzero(seg_lengths)[0]
-        segments = segments[non_zero_lengths]
-        seg_lengths = seg_lengths[non_zero_lengths]
+    # Streamlines are split in chunks processed in parallel, one per thread,
+    # each with its own accumulators to avoid races on voxels shared by
+    # streamlines. Each chunk uses 16 bytes per voxel of the bounding box.
+    nb_chunks = 1
+    if have_numba:
+        nb_chunks = max(1, min(get_num_threads(), len(sft.streamlines)))
+    bbox_sum_maps = np.zeros((nb_chunks,) + bbox_shape)
+    bbox_weight_maps = np.zeros((nb_chunks,) + bbox_shape)
 
-        # Those starting points are used for the segment vox_idx computations
-        seg_start = split_streamlines[non_zero_lengths]
-        vox_indices = (seg_start + (0.5 * segments)).astype(int)
+    if have_numba:
+        nb_outside = _bingham_metric_sum_kernel(
+            points, all_split_streamlines._offsets,
+            all_split_streamlines._lengths,
+            peaks, metric, metric_any, min_cos_theta, bool(length_weighting),
+            bbox_min, bbox_sum_maps, bbox_weight_maps)
+    else:
+        nb_outside = bingham_metric_sum_kernel(
+            points, all_split_streamlines._offsets,
+            all_split_streamlines._lengths,
+            peaks, metric, metric_any.view(np.uint8), min_cos_theta,
+            bool(length_weighting), bbox_min, bbox_sum_maps[0],
+            bbox_weight_maps[0])
 
-        normalization_weights = np.ones_like(seg_lengths)
-        if length_weighting:
-            normalization_weights = seg_lengths
+    if nb_outside > 0:
+        raise ValueError('{} streamline segments are outside of the volume.'
+                         .format(nb_outside))
 
-        normalized_seg = np.reshape(segments / seg_lengths[..., None], (-1, 3))
+    metric_sum_map[bbox] = bbox_sum_maps.sum(axis=0)
+    weight_map[bbox] = bbox_weight_maps.sum(axis=0)
+    return metric_sum_map, weight_map
 
-        for vox_idx, seg_dir, norm_weight in zip(vox_indices,
-                                                 normalized_seg,
-                                                 normalization_weights):
-            vox_idx = tuple(vox_idx)
-            bingham_at_idx = bingham_coeffs[vox_idx]  # (5, N_PARAMS)
 
-            bingham_peak_dir = bingham_to_peak_direction(bingham_at_idx)
-            cos_theta = np.abs(np.dot(seg_dir.reshape((-1, 3)),
-                                      bingham_peak_dir.T))
+if have_numba:
+    # Compiled at the first call (or loaded from the cache) rather than at
+    # import, so that importing this module does not start the threading
+    # layer.
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _bingham_metric_sum_kernel(points, offsets, lengths, peaks,
+                                   metric, metric_any, min_cos_theta,
+                                   length_weighting, bbox_min,
+                                   metric_sum_map, weight_map):
+        """
+        Accumulate the Bingham metric of the lobe best aligned with each
+        segment.
 
-            metric_val = 0.0
-            if (cos_theta > min_cos_theta).any():
-                lobe_idx = np.argmax(np.squeeze(cos_theta), axis=0)  # (n_segs)
-                metric_val = metric[vox_idx][lobe_idx]
+        Segment directions, lengths and voxel indices are computed on the fly
+        from the streamline points, so no intermediate array is allocated.
+        Streamlines are split in interleaved chunks processed in parallel,
+        each chunk accumulating in its own slice of the output maps.
+        Segments whose voxel is outside of the volume are skipped and
+        counted.
 
-            metric_sum_map[vox_idx] += metric_val * norm_weight
-            weight_map[vox_idx] += norm_weight
+        Parameters
+        ----------
+        points : ndarray (N, 3)
+            Concatenated points of the streamlines split at voxel faces.
+        offsets : ndarray (nb_streamlines,)
+            Index of the first point of each streamline.
+        lengths : ndarray (nb_streamlines,)
+            Number of points of each streamline.
+        peaks : ndarray (X, Y, Z, N_LOBES, 3)
+            Peak direction of each Bingham lobe.
+        metric : ndarray (X, Y, Z, N_LOBES)
+            The Bingham metric of interest.
+        metric_any : ndarray (X, Y, Z)
+            True where the metric is non-zero for at least one lobe.
+        min_cos_theta : float
+            Minimum cosine between a segment and a lobe peak direction.
+        length_weighting : bool
+            If True, segments are weighted by their length.
+        bbox_min : ndarray (3,)
+            First voxel of the bounding box covered by the output maps.
+        metric_sum_map : ndarray (nb_chunks, BX, BY, BZ)
+            Bingham metric sum map of each chunk over the bounding box,
+            updated in place.
+        weight_map : ndarray (nb_chunks, BX, BY, BZ)
+            Weight map of each chunk over the bounding box, updated in
+            place.
 
-    return metric_sum_map, weight_map
+        Returns
+        -------
+        nb_outside : int
+            Number of segments outside of the volume.
+        """
+        nb_lobes = peaks.shape[3]
+        nb_streamlines = offsets.shape[0]
+        nb_chunks = metric_sum_map.shape[0]
+        nb_outside = 0
+        for chunk in prange(nb_chunks):
+            for sl in range(chunk, nb_streamlines, nb_chunks):
+                for p in range(offsets[sl], offsets[sl] + lengths[sl] - 1):
+                    dx = points[p + 1, 0] - points[p, 0]
+                    dy = points[p + 1, 1] - points[p, 1]
+                    dz = points[p + 1, 2] - points[p, 2]
+                    seg_length = sqrt(dx * dx + dy * dy + dz * dz)
+                    if seg_length == 0.0:
+                        continue
+
+                    # The middle of the segment gives its voxel.
+                    i = int(points[p, 0] + 0.5 * dx)
+                    j = int(points[p, 1] + 0.5 * dy)
+                    k = int(points[p, 2] + 0.5 * dz)
+                    if i < 0 or i >= metric.shape[0] or \
+                            j < 0 or j >= metric.shape[1] or \
+                            k < 0 or k >= metric.shape[2]:
+                        nb_outside += 1
+                        continue
+
+                    # Same voxel, in the bounding box of the output maps.
+                    bi = i - bbox_min[0]
+                    bj = j - bbox_min[1]
+                    bk = k - bbox_min[2]
+
+                    w = seg_length if length_weighting else 1.0
+                    if not metric_any[i, j, k]:
+                        weight_map[chunk, bi, bj, bk] += w
+                        continue
+
+                    inv_length = 1.0 / seg_length
+                    nx = dx * inv_length
+                    ny = dy * inv_length
+                    nz = dz * inv_length
+
+                    # Argmax over lobes written with selects rather than
+                    # branches, keeping the first lobe on ties as np.argmax
+                    # does.
+                    best_l = 0
+                    best_c = 0.0
+                    for lobe_idx in range(nb_lobes):
+                        c = abs(nx * peaks[i, j, k, lobe_idx, 0] +
+                                ny * peaks[i, j, k, lobe_idx, 1] +
+                                nz * peaks[i, j, k, lobe_idx, 2])
+                        is_better = c > best_c
+                        best_c = c if is_better else best_c
+                        best_l = lobe_idx if is_better else best_l
+
+                    if best_c > min_cos_theta:
+                        metric_sum_map[chunk, bi, bj, bk] += \
+                            metric[i, j, k, best_l] * w
+                    weight_map[chunk, bi, bj, bk] += w
+
+        return nb_outside
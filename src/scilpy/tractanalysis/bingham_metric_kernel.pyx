@@ -0,0 +1,117 @@
+# encoding: utf-8
+# cython: profile=False, language_level=3
+
+# Compiled counterpart of the Numba kernel of
+# scilpy.tractanalysis.bingham_metric_along_streamlines, used when Numba is
+# not available. Both kernels must be kept in sync.
+
+cimport cython
+
+from libc.math cimport sqrt, fabs
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def bingham_metric_sum_kernel(const float[:, ::1] points,
+                              const Py_ssize_t[::1] offsets,
+                              const Py_ssize_t[::1] lengths,
+                              const float[:, :, :, :, ::1] peaks,
+                              const float[:, :, :, ::1] metric,
+                              const unsigned char[:, :, ::1] metric_any,
+                              double min_cos_theta,
+                              bint length_weighting,
+                              const Py_ssize_t[::1] bbox_min,
+                              double[:, :, ::1] metric_sum_map,
+                              double[:, :, ::1] weight_map):
+    """
+    Accumulate the Bingham metric of the lobe best aligned with each segment.
+
+    Serial version of the Numba kernel, accumulating directly in a single
+    pair of output maps.
+
+    Parameters
+    ----------
+    points : ndarray (N, 3)
+        Concatenated points of the streamlines split at voxel faces.
+    offsets : ndarray (nb_streamlines,)
+        Index of the first point of each streamline.
+    lengths : ndarray (nb_streamlines,)
+        Number of points of each streamline.
+    peaks : ndarray (X, Y, Z, N_LOBES, 3)
+        Peak direction of each Bingham lobe.
+    metric : ndarray (X, Y, Z, N_LOBES)
+        The Bingham metric of interest.
+    metric_any : ndarray (X, Y, Z)
+        Non-zero where the metric is non-zero for at least one lobe.
+    min_cos_theta : float
+        Minimum cosine between a segment and a lobe peak direction.
+    length_weighting : bool
+        If True, segments are weighted by their length.
+    bbox_min : ndarray (3,)
+        First voxel of the bounding box covered by the output maps.
+    metric_sum_map : ndarray (BX, BY, BZ)
+        Bingham metric sum map over the bounding box, updated in place.
+    weight_map : ndarray (BX, BY, BZ)
+        Weight map over the bounding box, updated in place.
+
+    Returns
+    -------
+    nb_outside : int
+        Number of segments outside of the volume, which are skipped.
+    """
+    cdef Py_ssize_t nb_lobes = peaks.shape[3]
+    cdef Py_ssize_t sl, p, i, j, k, bi, bj, bk, lobe_idx, best_l
+    cdef Py_ssize_t nb_outside = 0
+    cdef double dx, dy, dz, seg_length, inv_length, nx, ny, nz, w, c, best_c
+
+    with nogil:
+        for sl in range(offsets.shape[0]):
+            for p in range(offsets[sl], offsets[sl] + lengths[sl] - 1):
+                dx = points[p + 1, 0] - points[p, 0]
+                dy = points[p + 1, 1] - points[p, 1]
+                dz = points[p + 1, 2] - points[p, 2]
+                seg_length = sqrt(dx * dx + dy * dy + dz * dz)
+                if seg_length == 0.0:
+                    continue
+
+                # The middle of the segment gives its voxel.
+                i = <Py_ssize_t>(points[p, 0] + 0.5 * dx)
+                j = <Py_ssize_t>(points[p, 1] + 0.5 * dy)
+                k = <Py_ssize_t>(points[p, 2] + 0.5 * dz)
+                if i < 0 or i >= metric.shape[0] or \
+                        j < 0 or j >= metric.shape[1] or \
+                        k < 0 or k >= metric.shape[2]:
+                    nb_outside += 1
+                    continue
+
+                # Same voxel, in the bounding box of the output maps.
+                bi = i - bbox_min[0]
+                bj = j - bbox_min[1]
+                bk = k - bbox_min[2]
+
+                w = seg_length if length_weighting else 1.0
+                if not metric_any[i, j, k]:
+                    weight_map[bi, bj, bk] += w
+                    continue
+
+                inv_length = 1.0 / seg_length
+                nx = dx * inv_length
+                ny = dy * inv_length
+                nz = dz * inv_length
+
+                best_l = 0
+                best_c = 0.0
+                for lobe_idx in range(nb_lobes):
+                    c = fabs(nx * peaks[i, j, k, lobe_idx, 0] +
+                             ny * peaks[i, j, k, lobe_idx, 1] +
+                             nz * peaks[i, j, k, lobe_idx, 2])
+                    if c > best_c:
+                        best_c = c
+                        best_l = lobe_idx
+
+                if best_c > min_cos_theta:
+                    metric_sum_map[bi, bj, bk] += metric[i, j, k, best_l] * w
+                weight_map[bi, bj, bk] += w
+
+    return nb_outside
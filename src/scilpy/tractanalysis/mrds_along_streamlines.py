@@ -5,6 +5,11 @@ import numpy as np
 from scilpy.tractanalysis.voxel_boundary_intersection import\
     subdivide_streamlines_at_voxel_faces
 
+# Number of streamlines processed at once by
+# mrds_metric_sums_along_streamlines. The per-segment arrays of a chunk use
+# about 200 bytes per segment.
+STREAMLINES_CHUNK_SIZE = 1000
+
 
 def mrds_metrics_along_streamlines(sft, mrds_pdds,
                                    metrics, max_theta,
@@ -80,54 +85,68 @@ def mrds_metric_sums_along_streamlines(sft, mrds_pdds, metrics,
     weight_map = np.zeros(metrics[0].shape[:-1])
     min_cos_theta = np.cos(np.radians(max_theta))
 
+    # Reshape MRDS PDDs to (X, Y, Z, 3, N_TENSORS), so that each voxel
+    # directly gives the right operand of the product with a segment.
+    mrds_pdds = mrds_pdds.reshape(mrds_pdds.shape[0],
+                                  mrds_pdds.shape[1],
+                                  mrds_pdds.shape[2], -1, 3)
+    mrds_pdds_t = np.ascontiguousarray(np.swapaxes(mrds_pdds, -2, -1))
+
     sft.streamlines._data = sft.streamlines._data.astype(np.float32)
     all_split_streamlines = \
         subdivide_streamlines_at_voxel_faces(sft.streamlines)
-    for split_streamlines in all_split_streamlines:
-        segments = split_streamlines[1:] - split_streamlines[:-1]
-        seg_lengths = np.linalg.norm(segments, axis=1)
 
-        # Remove points where the segment is zero.
-        # This removes numpy warnings of division by zero.
-        non_zero_lengths = np.nonzero(seg_lengths)[0]
-        segments = segments[non_zero_lengths]
-        seg_lengths = seg_lengths[non_zero_lengths]
+    # Streamlines are processed by chunks, each chunk at once on its
+    # concatenated points. This bounds the memory used by the per-segment
+    # arrays, while keeping the Python loop short.
+    offsets = all_split_streamlines._offsets
+    lengths = all_split_streamlines._lengths
+    for first in range(0, len(offsets), STREAMLINES_CHUNK_SIZE):
+        last = min(first + STREAMLINES_CHUNK_SIZE, len(offsets))
+        start = offsets[first]
+        end = offsets[last - 1] + lengths[last - 1]
+        points = all_split_streamlines._data[start:end]
+
+        # A segment joins each point to the next one, except from the last
+        # point of a streamline to the first point of the following one.
+        is_last_point = np.zeros(len(points), dtype=bool)
+        is_last_point[offsets[first:last] + lengths[first:last]
+                      - 1 - start] = True
+        segments = points[1:] - points[:-1]
+        seg_sq_lengths = np.einsum('ij,ij->i', segments, segments)
+
+        # Remove segments across streamlines and segments of length zero.
+        # This also removes numpy warnings of division by zero.
+        valid_segments = np.nonzero(~is_last_point[:-1] &
+                                    (seg_sq_lengths > 0))[0]
+        segments = segments[valid_segments]
+        seg_lengths = np.sqrt(seg_sq_lengths[valid_segments])
 
         # Those starting points are used for the segment vox_idx computations
-        seg_start = split_streamlines[non_zero_lengths]
+        seg_start = points[valid_segments]
         vox_indices = (seg_start + (0.5 * segments)).astype(int)
 
         normalization_weights = np.ones_like(seg_lengths)
         if length_weighting:
             normalization_weights = seg_lengths
 
-        normalized_seg = np.reshape(segments / seg_lengths[..., None], (-1, 3))
-
-        # Reshape MRDS PDDs
-        mrds_pdds = mrds_pdds.reshape(mrds_pdds.shape[0],
-                                      mrds_pdds.shape[1],
-                                      mrds_pdds.shape[2], -1, 3)
-
-        for vox_idx, seg_dir, norm_weight in zip(vox_indices,
-                                                 normalized_seg,
-                                                 normalization_weights):
-            vox_idx = tuple(vox_idx)
-
-            mrds_peak_dir = mrds_pdds[vox_idx]
-
-            cos_theta = np.abs(np.dot(seg_dir.reshape((-1, 3)),
-                                      mrds_peak_dir.T))
-
-            metric_val = [0.0]*len(metrics)
-            if (cos_theta > min_cos_theta).any():
-                fixel_idx = np.argmax(np.squeeze(cos_theta),
-                                      axis=0)  # (n_segs)
-
-                for metric_idx, curr_metric in enumerate(metrics):
-                    metric_val[metric_idx] = curr_metric[vox_idx][fixel_idx]
-
-            for metric_idx, curr_metric in enumerate(metrics):
-                metrics_sum_map[metric_idx][vox_idx] += metric_val[metric_idx] * norm_weight
-                weight_map[vox_idx] += norm_weight
+        normalized_seg = segments * (1. / seg_lengths)[:, None]
+
+        # All segments of the chunk are matched to their closest fixel at
+        # once.
+        vox_indices = tuple(vox_indices.T)
+        cos_theta = np.abs(np.einsum('sd,sdn->sn', normalized_seg,
+                                     mrds_pdds_t[vox_indices]))
+        fixel_idx = np.argmax(cos_theta, axis=1)
+        is_aligned = np.max(cos_theta, axis=1) > min_cos_theta
+
+        # np.add.at accumulates segments falling in the same voxel.
+        for metric_idx, curr_metric in enumerate(metrics):
+            metric_val = np.where(is_aligned,
+                                  curr_metric[vox_indices + (fixel_idx,)],
+                                  0.0)
+            np.add.at(metrics_sum_map[metric_idx], vox_indices,
+                      metric_val * normalization_weights)
+            np.add.at(weight_map, vox_indices, normalization_weights)
 
     return metrics_sum_map, weight_map
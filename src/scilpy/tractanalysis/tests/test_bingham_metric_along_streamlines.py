@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from nibabel.streamlines import ArraySequence
+
+from scilpy.reconst.bingham import bingham_to_peak_direction
+from scilpy.tests.arrays import fodf_3x3_bingham, fodf_3x3_bingham_fd
+from scilpy.tests.utils import build_sft_in_voxel_space
+from scilpy.tractanalysis.bingham_metric_along_streamlines import \
+    _bingham_metric_sum_kernel, bingham_metric_map_along_streamlines
+from scilpy.tractanalysis.bingham_metric_kernel import \
+    bingham_metric_sum_kernel
+from scilpy.tractanalysis.voxel_boundary_intersection import \
+    subdivide_streamlines_at_voxel_faces
+
+
+def test_bingham_metric_map_along_streamlines():
+    bingham = fodf_3x3_bingham.copy()
+    fd = fodf_3x3_bingham_fd.copy()
+    peaks = bingham_to_peak_direction(fodf_3x3_bingham.copy())
+
+    # Creating short streamlines (2 points) aligned on the first lobe,
+    # staying inside their voxel. Voxel [2, 1, 0] has no lobe.
+    streamlines = []
+    for i in range(2):
+        start_pt = np.asarray([i + 0.5, 1.5, 0.5])
+        second_pt = start_pt + 0.2 * peaks[i, 1, 0, 0]
+        streamlines.append(np.vstack([start_pt, second_pt],
+                                     dtype=np.float32))
+    sft = build_sft_in_voxel_space(streamlines, bingham.shape[:3])
+
+    fd_map = bingham_metric_map_along_streamlines(sft, bingham, fd,
+                                                  max_theta=15,
+                                                  length_weighting=False)
+
+    # Should have the same size as the volume
+    assert np.array_equal(fd_map.shape, bingham.shape[:3])
+
+    # Each voxel crossed gets the FD of the lobe aligned with the streamline
+    expected = np.zeros(bingham.shape[:3])
+    expected[:2, 1, 0] = fd[:2, 1, 0, 0]
+    assert np.allclose(fd_map, expected)
+
+    # Same streamlines, but perpendicular to the lobes: no lobe is aligned,
+    # so the mean is zero everywhere.
+    streamlines = []
+    for i in range(2):
+        start_pt = np.asarray([i + 0.5, 1.5, 0.5])
+        ortho = np.cross(peaks[i, 1, 0, 0], [0., 0., 1.])
+        ortho /= np.linalg.norm(ortho)
+        second_pt = start_pt + 0.2 * ortho
+        streamlines.append(np.vstack([start_pt, second_pt],
+                                     dtype=np.float32))
+    sft = build_sft_in_voxel_space(streamlines, bingham.shape[:3])
+
+    fd_map = bingham_metric_map_along_streamlines(sft, bingham, fd,
+                                                  max_theta=15,
+                                                  length_weighting=False)
+    assert np.count_nonzero(fd_map) == 0
+
+
+def test_bingham_metric_map_outside_volume():
+    # A streamline leaving the volume must not be read or written out of
+    # bounds.
+    streamline = np.array([[1.5, 1.5, 0.5],
+                           [5.5, 1.5, 0.5]], dtype=np.float32)
+    sft = build_sft_in_voxel_space([streamline],
+                                   fodf_3x3_bingham.shape[:3])
+
+    with pytest.raises(ValueError):
+        bingham_metric_map_along_streamlines(sft, fodf_3x3_bingham,
+                                             fodf_3x3_bingham_fd,
+                                             max_theta=15,
+                                             length_weighting=False)
+
+
+def test_bingham_metric_sum_kernels():
+    # The Cython kernel, used when Numba is not available, must give the
+    # same sums as the Numba kernel.
+    peaks = np.ascontiguousarray(bingham_to_peak_direction(
+        fodf_3x3_bingham.astype(np.float32)))
+    fd = np.ascontiguousarray(fodf_3x3_bingham_fd, dtype=np.float32)
+    fd_any = np.any(fd, axis=-1)
+    min_cos_theta = np.cos(np.radians(30))
+
+    rng = np.random.default_rng(0)
+    streamlines = ArraySequence(
+        [rng.uniform(0.01, [2.99, 2.99, 0.99],
+                     size=(rng.integers(2, 10), 3)).astype(np.float32)
+         for _ in range(20)])
+    split_streamlines = subdivide_streamlines_at_voxel_faces(streamlines)
+    bbox_min = np.zeros(3, dtype=np.intp)
+
+    for length_weighting in [False, True]:
+        numba_sums = np.zeros((2,) + fd.shape[:-1])
+        numba_weights = np.zeros((2,) + fd.shape[:-1])
+        _bingham_metric_sum_kernel(split_streamlines._data,
+                                   split_streamlines._offsets,
+                                   split_streamlines._lengths,
+                                   peaks, fd, fd_any, min_cos_theta,
+                                   length_weighting, bbox_min,
+                                   numba_sums, numba_weights)
+
+        cython_sums = np.zeros(fd.shape[:-1])
+        cython_weights = np.zeros(fd.shape[:-1])
+        bingham_metric_sum_kernel(split_streamlines._data,
+                                  split_streamlines._offsets,
+                                  split_streamlines._lengths,
+                                  peaks, fd, fd_any.view(np.uint8),
+                                  min_cos_theta, length_weighting,
+                                  bbox_min, cython_sums, cython_weights)
+
+        assert np.count_nonzero(cython_sums) > 0
+        assert np.allclose(numba_sums.sum(axis=0), cython_sums, atol=1e-6)
+        assert np.allclose(numba_weights.sum(axis=0), cython_weights,
+                           atol=1e-6)
+
+
+def test_bingham_metric_sum_kernels_outside_volume():
+    # Both kernels skip and count the segments outside of the volume.
+    peaks = np.ascontiguousarray(bingham_to_peak_direction(
+        fodf_3x3_bingham.astype(np.float32)))
+    fd = np.ascontiguousarray(fodf_3x3_bingham_fd, dtype=np.float32)
+    fd_any = np.any(fd, axis=-1)
+    points = np.array([[1.5, 1.5, 0.5],
+                       [5.5, 1.5, 0.5],
+                       [1.5, -3.5, 0.5]], dtype=np.float32)
+    offsets = np.array([0], dtype=np.intp)
+    lengths = np.array([3], dtype=np.intp)
+    bbox_min = np.zeros(3, dtype=np.intp)
+
+    numba_sums = np.zeros((1,) + fd.shape[:-1])
+    numba_weights = np.zeros((1,) + fd.shape[:-1])
+    assert _bingham_metric_sum_kernel(points, offsets, lengths, peaks, fd,
+                                      fd_any, 0.5, False, bbox_min,
+                                      numba_sums, numba_weights) == 2
+    assert np.count_nonzero(numba_weights) == 0
+
+    cython_sums = np.zeros(fd.shape[:-1])
+    cython_weights = np.zeros(fd.shape[:-1])
+    assert bingham_metric_sum_kernel(points, offsets, lengths, peaks, fd,
+                                     fd_any.view(np.uint8), 0.5, False,
+                                     bbox_min, cython_sums,
+                                     cython_weights) == 2
+    assert np.count_nonzero(cython_weights) == 0
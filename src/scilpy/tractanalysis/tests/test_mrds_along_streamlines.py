@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from scilpy.tests.utils import build_sft_in_voxel_space
+from scilpy.tractanalysis import mrds_along_streamlines
+from scilpy.tractanalysis.mrds_along_streamlines import \
+    mrds_metric_sums_along_streamlines
+
+
+def _get_mrds_volume():
+    # Three voxels along x, each with a first tensor along x and a second
+    # one along y.
+    shape = (3, 1, 1)
+    pdds = np.zeros(shape + (2, 3))
+    pdds[..., 0, 0] = 1.
+    pdds[..., 1, 1] = 1.
+    metric = np.arange(1., 7.).reshape(shape + (2,))
+    return shape, pdds.reshape(shape + (6,)), metric
+
+
+def _get_streamlines():
+    return [
+        # Along x in voxel [0, 0, 0]: two segments in the same voxel, with
+        # a zero-length segment in between.
+        np.array([[0.2, 0.5, 0.5],
+                  [0.4, 0.5, 0.5],
+                  [0.4, 0.5, 0.5],
+                  [0.8, 0.5, 0.5]], dtype=np.float32),
+        # Along z in voxel [1, 0, 0]: perpendicular to both tensors. The
+        # jump from the end of the previous streamline to its start is
+        # mostly along x, but it is not a segment.
+        np.array([[1.5, 0.5, 0.2],
+                  [1.5, 0.5, 0.8]], dtype=np.float32),
+        # Along y in voxel [2, 0, 0]: aligned with the second tensor.
+        np.array([[2.5, 0.2, 0.5],
+                  [2.5, 0.8, 0.5]], dtype=np.float32)]
+
+
+def test_mrds_metric_sums_along_streamlines(monkeypatch):
+    shape, pdds, metric = _get_mrds_volume()
+
+    # Processing the streamlines one by one (one chunk each) must not
+    # change the result.
+    for chunk_size in [1000, 1]:
+        monkeypatch.setattr(mrds_along_streamlines,
+                            'STREAMLINES_CHUNK_SIZE', chunk_size)
+
+        sft = build_sft_in_voxel_space(_get_streamlines(), shape)
+        sums, weights = mrds_metric_sums_along_streamlines(
+            sft, pdds, [metric], max_theta=20, length_weighting=False)
+
+        assert np.allclose(sums[0], [[[2 * metric[0, 0, 0, 0]]], [[0.]],
+                                     [[metric[2, 0, 0, 1]]]])
+        assert np.allclose(weights, [[[2.]], [[1.]], [[1.]]])
+
+        sft = build_sft_in_voxel_space(_get_streamlines(), shape)
+        sums, weights = mrds_metric_sums_along_streamlines(
+            sft, pdds, [metric], max_theta=20, length_weighting=True)
+
+        assert np.allclose(sums[0], [[[0.6 * metric[0, 0, 0, 0]]], [[0.]],
+                                     [[0.6 * metric[2, 0, 0, 1]]]])
+        assert np.allclose(weights, [[[0.6]], [[0.6]], [[0.6]]])